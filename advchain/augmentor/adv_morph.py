@@ -1,3 +1,4 @@
+import functools
 import logging
 
 import torch
@@ -11,31 +12,50 @@ logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
 
-def get_base_grid(batch_size, image_height, image_width, use_gpu=True):
+def _resolve_device(device):
+    '''
+    pin 'cuda' to the current cuda device, so that cached tensors are keyed on the device they live on
+    '''
+    device = torch.device(device)
+    if device.type == 'cuda' and device.index is None:
+        device = torch.device('cuda', torch.cuda.current_device())
+    return device
+
+
+def get_base_grid(batch_size, image_height, image_width, use_gpu=True, device=None, dtype=torch.float32):
     '''
 
     :param batch_size:
     :param image_height:
     :param image_width:
-    :param use_gpu:
-    :param requires_grad:
+    :param use_gpu: used to pick the device if device is not given
+    :param device: torch device to build the grid on
+    :param dtype: data type of the grid, grid values lie in [-1,1], so float16/bfloat16 grids are fine
+    for sampling positions (e.g. reduced precision integration)
     :return:
     grid-wh: 4d grid N*2*H*W
     '''
-    # get base grid
+    if device is None:
+        device = torch.device('cuda') if use_gpu else torch.device('cpu')
+    grid_wh = _base_grid(image_height, image_width, _resolve_device(device), dtype)
+    # copy out of the cache, callers may modify the grid in-place
+    return grid_wh.expand(batch_size, 2, image_height, image_width).clone()
+
+
+@functools.lru_cache(maxsize=16)
+def _base_grid(image_height, image_width, device, dtype=torch.float32):
+    '''
+    cached base grid built directly on the target device, shared by all samples in a batch
+    :return:
+    grid-wh: 4d grid 1*2*H*W, broadcasts against N*2*H*W fields, do not modify it in-place
+    '''
+    # build in (at least) float32 and round once, linspace in half precision accumulates larger errors
+    build_dtype = torch.promote_types(dtype, torch.float32)
     y_ind, x_ind = torch.meshgrid(
-        [torch.linspace(-1, 1, image_height), torch.linspace(-1, 1, image_width)])  # image space [0-H]
-    x_ind = x_ind.unsqueeze(0).unsqueeze(0)  # 1*1*H*W
-    y_ind = y_ind.unsqueeze(0).unsqueeze(0)  # 1*1*H*W
-    x_ind = x_ind.repeat(batch_size, 1, 1, 1)  # N*1*H*W
-    y_ind = y_ind.repeat(batch_size, 1, 1, 1)
-    x_ind.float()
-    y_ind.float()
-    if use_gpu:
-        x_ind = x_ind.cuda()
-        y_ind = y_ind.cuda()
-    grid_wh = torch.cat((x_ind, y_ind), dim=1)
-    return grid_wh
+        [torch.linspace(-1, 1, image_height, device=device, dtype=build_dtype),
+         torch.linspace(-1, 1, image_width, device=device, dtype=build_dtype)])  # image space [0-H]
+    grid_wh = torch.stack((x_ind, y_ind), dim=0).unsqueeze(0)  # 1*2*H*W
+    return grid_wh.to(dtype)
 
 
 def calculate_image_diff(images):
@@ -46,16 +66,14 @@ def calculate_image_diff(images):
     dy: difference in y-direction: batch*ch*H*W
 
     """
-    dx = torch.zeros_like(images)
-    dy = torch.zeros_like(images)
-    # forward difference in first column
-    dx[:, :, :, 0] = images[:, :, :, 1] - images[:, :, :, 0]
-    dx[:, :, :, -1] = images[:, :, :, -1] - images[:, :, :, -2]
-    dx[:, :, :, 1:-1] = 0.5 * (images[:, :, :, 2:] - images[:, :, :, :-2])
-
-    dy[:, :, 0, :] = images[:, :, 1, :] - images[:, :, 0, :]
-    dy[:, :, -1, :] = images[:, :, -1, :] - images[:, :, -2, :]
-    dy[:, :, 1:-1, :] = 0.5 * (images[:, :, 2:, :] - images[:, :, :-2, :])
+    # forward difference in the first column/row, backward difference in the last one
+    # and central difference in between, each assembled with a single concatenation
+    dx = torch.cat((images[:, :, :, 1:2] - images[:, :, :, 0:1],
+                    0.5 * (images[:, :, :, 2:] - images[:, :, :, :-2]),
+                    images[:, :, :, -1:] - images[:, :, :, -2:-1]), dim=3)
+    dy = torch.cat((images[:, :, 1:2, :] - images[:, :, 0:1, :],
+                    0.5 * (images[:, :, 2:, :] - images[:, :, :-2, :]),
+                    images[:, :, -1:, :] - images[:, :, -2:-1, :]), dim=2)
     return dx, dy
 
 
@@ -72,52 +90,82 @@ def calculate_jacobian_determinant(data, type='displacement'):
     assert type in type_library, 'only support {} but found: '.format(
         type_library, type)
     # for each point on the grid, get a 4d tuple [dxx,dyy,dxy,dyx] and calc the determinant using det=(1+dxx)*(1+dyy)-dxy*dyx
-    dx = data[:, [0], :, :]
-    dy = data[:, [1], :, :]
-    dxx, dxy = calculate_image_diff(dx)
-    dyx, dyy = calculate_image_diff(dy)
+    # differentiate both channels at once: grad_x=[dxx,dyx], grad_y=[dxy,dyy]
+    grad_x, grad_y = calculate_image_diff(data)
+    dxx, dyx = grad_x[:, 0:1], grad_x[:, 1:2]
+    dxy, dyy = grad_y[:, 0:1], grad_y[:, 1:2]
 
-    determinant = (1+dxx)*(1+dyy)-dxy*dyx
+    determinant = torch.addcmul(-dxy*dyx, 1+dxx, 1+dyy)
     return determinant
 
 
-def integrate_by_add(basegrid_wh, dxy):
+def _scaling_and_squaring(phi, nb_steps):
+    # grid_sample has no out= variant. with autograd every intermediate phi is kept for the backward pass anyway;
+    # without it, rebinding phi frees the previous field, so the caching allocator reuses two blocks in turn.
+    for i in range(nb_steps):
+        # e.g. phi(2^i/2^n) =phi(2^(i-1)/2^n) \circ phi((2^(i-1)/2^n))
+        phi = applyComposition2D(phi, phi)
+    return phi
+
+
+def _scaling_and_squaring_offsets(offsets, grid_wh, nb_steps):
     '''
-    transform images with the given deformation fields
-    :param basegrid_w:N*1*H*W: horizontal grid
-    :param basegrid_H:N*1*H*W: vertical grid
-    :param dx: dense deformation in horizontal direction:N*1*H*W
-    :param dy: dense deformation in vertical direction:N*1*H*W
-    :return:
-    new_grid: the input to the torch grid_sample function.
-    torch tensor matrix: N*H*W*2:[dx,dy]
+    scaling and squaring on the offsets u of phi=x+u, with u(x) <- u(x) + u(x+u(x)).
+    in low precision, tiny offsets are lost when added to grid values ~1, so keep the offsets as the state
+    and use x+u only as sampling positions. matches applyComposition2D, including its border padding.
     '''
+    for i in range(nb_steps):
+        phi = grid_wh + offsets
+        offsets = offsets + (torch.clamp(phi, -1, 1) - phi) + applyComposition2D(offsets, phi)
+    return offsets
 
-    basegrid_wh += dxy
-    # basegrid_wh = torch.clamp(basegrid_wh, -1, 1)
-    return basegrid_wh
+
+@functools.lru_cache(maxsize=None)
+def _compiled(loop_fn):
+    '''
+    shape-specialized torch.compile version of a scaling and squaring loop, compiled on first call
+    falls back to the eager loop for pytorch<2.0
+    '''
+    if not hasattr(torch, 'compile'):
+        logger.warning('torch.compile is not available, use eager scaling and squaring')
+        return loop_fn
+    return torch.compile(loop_fn, dynamic=False)
 
 
-def vectorFieldExponentiation2D(duv, nb_steps=8, type='ss', use_gpu=True):
+def vectorFieldExponentiation2D(duv, nb_steps=8, type='ss', use_gpu=True, base_grid=None, compile=False, dtype=None):
     '''
         Computes fast vector field exponentiation as proposed in:
         https://hal.inria.fr/file/index/docid/349600/filename/DiffeoDemons-NeuroImage08-Vercauteren.pdf
         :param duv: velocity field in ,y direction : N*2*H*W,
         :param N: number of steps for integration
+        :param base_grid: optional precomputed base grid 1*2*H*W or N*2*H*W,
+        built (and cached) on duv.device if not given
+        :param compile: if true, run the scaling and squaring loop through torch.compile,
+        this also applies to the reduced precision loop (dtype)
+        :param dtype: optional lower precision data type (e.g. torch.float16/torch.bfloat16)
+        for the scaling and squaring steps, the result is cast back to duv.dtype. only used for type='ss'.
         :return:
         integrated deformation field at time point 1: N2HW, [dx,dy]
    '''
 
     # phi(i/2^n)=x+u(x)
-    grid_wh = get_base_grid(batch_size=duv.size(0), image_height=duv.size(2), image_width=duv.size(3),
-                            use_gpu=use_gpu)
-    duv_interval = duv/(2.0 ** nb_steps)
-    phi = integrate_by_add(grid_wh, duv_interval)
+    if base_grid is None:
+        grid_wh = _base_grid(duv.size(2), duv.size(3), duv.device, duv.dtype)
+    else:
+        grid_wh = base_grid.detach()
+    inv = 1.0 / (1 << nb_steps)
+    if dtype is not None and type == 'ss':
+        loop_fn = _compiled(_scaling_and_squaring_offsets) if compile else _scaling_and_squaring_offsets
+        offsets = loop_fn((duv * inv).to(dtype), grid_wh.to(dtype), nb_steps)
+        return offsets.to(duv.dtype)
+    # out-of-place, the (cached) base grid must stay untouched. the scaling is folded into the add (one kernel)
+    phi = torch.add(grid_wh, duv, alpha=inv)
 
     if type == 'ss':
-        for i in range(nb_steps):
-            # e.g. phi(2^i/2^n) =phi(2^(i-1)/2^n) \circ phi((2^(i-1)/2^n))
-            phi = applyComposition2D(phi, phi)
+        if compile:
+            phi = _compiled(_scaling_and_squaring)(phi, nb_steps)
+        else:
+            phi = _scaling_and_squaring(phi, nb_steps)
     else:
         # euler integration, here nb_steps becomes exact time steps
         interval_phi = phi
@@ -181,8 +229,20 @@ class AdvMorph(AdvTransformBase):
         self.num_steps = 8  # internal steps for scaling and squaring intergration
         self.interpolator_mode = 'bilinear'
         self.integration_type = 'ss'
+        # compile the scaling and squaring loop with torch.compile (pytorch>=2.0),
+        # pays off for repeated calls with fixed shapes
+        self.compile_integration = False
+        # optional lower precision (e.g. torch.float16) for the scaling and squaring steps, None: keep float32
+        self.integration_dtype = None
+        # if true, integrate the forward and inverse deformation in one batched call [v;-v] (no grad only),
+        # for callers that always need both, e.g. forward followed by backward
+        self.batch_directions = False
         self.param = None
         self.power_iteration = power_iteration
+        # 1D gaussian kernels, keyed by (kernel_size, sigma, channels)
+        self._gaussian_kernels = {}
+        # forward and inverse deformation of the current parameters, shared by forward and backward (no grad only)
+        self._deformation_cache = None
 
     def init_config(self, config_dict):
         '''
@@ -200,8 +260,13 @@ class AdvMorph(AdvTransformBase):
         return random transformaion parameters
         '''
         self.init_config(self.config_dict)
+        # 1*2*H*W, broadcasts over the batch
         self.base_grid_wh = get_base_grid(
-            batch_size=self.data_size[0], image_height=self.data_size[2], image_width=self.data_size[3], use_gpu=self.use_gpu)
+            batch_size=1, image_height=self.data_size[2], image_width=self.data_size[3], use_gpu=self.use_gpu)
+        # prebuild the kernels used to smooth the velocity field
+        for sigma in (self.sigma, self.get_smooth_sigma(self.vector_size[0], self.vector_size[1])):
+            self._gaussian_kernels[(self.gaussian_ks, sigma, 2)] = self.get_gaussian_kernel(
+                kernel_size=self.gaussian_ks, sigma=sigma, channels=2)
 
         vector = self.init_velocity(
             batch_size=self.data_size[0],  height=self.vector_size[0], width=self.vector_size[1], use_zero=False)
@@ -223,12 +288,7 @@ class AdvMorph(AdvTransformBase):
             self.init_parameters()
         if interpolation_mode is None:
             interpolation_mode = self.interpolator_mode
-        if self.power_iteration and self.is_training:
-            dxy, displacement = self.get_deformation_displacement_field(
-                duv=self.xi*self.param)
-        else:
-            dxy, displacement = self.get_deformation_displacement_field(
-                duv=self.param)
+        dxy, displacement = self._get_deformation()
         transformed_image = self.transform(data, dxy, mode=interpolation_mode)
 
         self.diff = transformed_image-data
@@ -242,12 +302,7 @@ class AdvMorph(AdvTransformBase):
         '''
         if interpolation_mode is None:
             interpolation_mode = self.interpolator_mode
-        if self.power_iteration and self.is_training:
-            dxy, displacement = self.get_deformation_displacement_field(
-                duv=-self.xi*self.param)
-        else:
-            dxy, displacement = self.get_deformation_displacement_field(
-                duv=-self.param)
+        dxy, displacement = self._get_deformation(inverse=True)
         transformed_image = self.transform(
             data, dxy, mode=self.interpolator_mode)
         if self.debug:
@@ -260,13 +315,16 @@ class AdvMorph(AdvTransformBase):
     def predict_backward(self, data):
         return self.backward(data)
 
-    def get_deformation_displacement_field(self, duv=None):
+    def get_deformation_displacement_field(self, duv=None, inverse=False):
+        '''
+        :param duv: velocity field N*2*h*w, if None, use the current parameters
+        :param inverse: if true, integrate -duv to get the inverse deformation
+        :return:
+        deformation grid N*2*H*W and displacement N*H*W*2
+        '''
         if duv is None:
             duv = self.param
-        dxy = self.DemonsCompose(
-            duv=duv, init_deformation_dxy=self.base_grid_wh, smooth=True)
-        disp = dxy.permute(0, 2, 3, 1)-self.base_grid_wh.permute(0, 2, 3, 1)
-        return dxy, disp
+        return self._integrate_direction(self.smooth_velocity(duv, smooth=True), inverse)
 
     def init_velocity(self, batch_size, height, width, use_zero=False):
         '''
@@ -281,8 +339,8 @@ class AdvMorph(AdvTransformBase):
         # offsets = offsets.cuda()
 
         if not use_zero:
-            duv = (torch.rand(batch_size, 2, height, width,
-                              device=self.device, dtype=torch.float32)*2-1)
+            duv = torch.empty(batch_size, 2, height, width,
+                              device=self.device, dtype=torch.float32).uniform_(-1, 1)
             duv = self.rescale_parameters(duv)
         else:
             duv = torch.zeros(batch_size, 2, height, width,
@@ -294,87 +352,185 @@ class AdvMorph(AdvTransformBase):
         '''
         apply gaussian smooth functions to deformation field to avoid unrealistic and too aggressive deformations
         :param input: NCHW
-        :param iter: max number of iterations, avoid infinestimal.
+        :param iter: number of smoothing passes, 0 returns the input unchanged. on fields that are large compared
+            to the kernel, the passes are applied as one pass with sigma*sqrt(iter)
         :return: smoothed deformation
         '''
+        if iter < 1:
+            return inputvector
+        if iter > 1:
+            folded_sigma = sigma * math.sqrt(iter)
+            folded_size = max(kernel_size, 2 * int(3.5 * folded_sigma) + 1)
+            # repeated gaussian blurs compose to a single one with sigma*sqrt(iter),
+            # except near the zero padded border, which matters on small fields
+            if min(inputvector.size(2), inputvector.size(3)) >= 4 * folded_size:
+                sigma, iter = folded_sigma, 1
         n_channel = inputvector.size(1)
-        gaussian_conv = self.get_gaussian_kernel(
-            kernel_size=kernel_size, sigma=sigma, channels=n_channel)
+        key = (kernel_size, sigma, n_channel)
+        if key not in self._gaussian_kernels:
+            self._gaussian_kernels[key] = self.get_gaussian_kernel(
+                kernel_size=kernel_size, sigma=sigma, channels=n_channel)
+        kernel_x = self._gaussian_kernels[key].to(inputvector.dtype)
+        kernel_y = kernel_x.transpose(2, 3)
+        pad_size = kernel_x.size(3) // 2
         for i in range(iter):
-            inputvector = gaussian_conv(inputvector)
+            # the 2D gaussian is separable: filter rows, then columns
+            inputvector = F.conv2d(
+                inputvector, kernel_x, padding=(0, pad_size), groups=n_channel)
+            inputvector = F.conv2d(
+                inputvector, kernel_y, padding=(pad_size, 0), groups=n_channel)
         return inputvector
 
     def get_gaussian_kernel(self, kernel_size=5, sigma=8, channels=3):
-        # Create a x, y coordinate grid of shape (kernel_size, kernel_size, 2)
+        '''
+        build a 1D gaussian kernel for separable depthwise convolution
+        :return: kernel weight: channels*1*1*kernel_size, apply it along x, then (transposed) along y
+        '''
         # Use n_sd sigmas
         if kernel_size < 2 * int(3.5 * sigma) + 1:
             # odd size so padding results in correct output size
             kernel_size = 2 * int(3.5 * sigma) + 1
 
-        x_coord = torch.arange(kernel_size)
-        x_grid = x_coord.repeat(kernel_size).view(kernel_size, kernel_size)
-        y_grid = x_grid.t()
-        xy_grid = torch.stack([x_grid, y_grid], dim=-1).float()
+        x_coord = torch.arange(
+            kernel_size, device=self.device, dtype=torch.float32)
 
         mean = (kernel_size - 1) / 2.
         variance = sigma ** 2.
 
-        # Calculate the 2-dimensional gaussian kernel which is
-        # the product of two gaussian distributions for two different
-        # variables (in this case called x and y)
-        gaussian_kernel = (1. / (2. * math.pi * variance)) * \
-            torch.exp(
-            -torch.sum((xy_grid - mean) ** 2., dim=-1) /
-            (2 * variance)
-        )
+        # the 2-dimensional gaussian kernel is the product of two 1-dimensional
+        # gaussian distributions in x and y, so one of them is enough.
+        # softmax over the exponents normalizes the kernel to sum 1 in one (numerically stable) pass
+        gaussian_kernel = F.softmax(-(x_coord - mean) ** 2. / (2 * variance), dim=0)
 
-        # Make sure sum of values in gaussian kernel equals 1.
-        gaussian_kernel = gaussian_kernel / torch.sum(gaussian_kernel)
-
-        # Reshape to 2d depthwise convolutional weight
-        gaussian_kernel = gaussian_kernel.view(1, 1, kernel_size, kernel_size)
+        # Reshape to depthwise convolutional weight
+        gaussian_kernel = gaussian_kernel.view(1, 1, 1, kernel_size)
         gaussian_kernel = gaussian_kernel.repeat(channels, 1, 1, 1)
-        pad_size = kernel_size // 2
-        gaussian_filter = nn.Conv2d(in_channels=channels, out_channels=channels,
-                                    kernel_size=kernel_size, groups=channels, dilation=1, stride=1, bias=False,
-                                    padding=pad_size)
-
-        gaussian_filter.weight.data = gaussian_kernel
-        gaussian_filter.weight.data = gaussian_kernel
-        gaussian_filter.weight.requires_grad = False
-        if self.use_gpu:
-            gaussian_filter = gaussian_filter.cuda()
-        return gaussian_filter
+        return gaussian_kernel
 
     def DemonsCompose(self, duv, init_deformation_dxy, smooth=False):
         '''
         :param duv: velocity field
         :param init_deformation_dxy:
+        :param smooth: apply additional smoothing to the deformation (on the low resolution velocity)
         :return:
         new composed_deformation_grid N*2*H*W
         '''
+        return self.integrate_velocity(self.smooth_velocity(duv, smooth=smooth), init_deformation_dxy)
+
+    def get_velocity(self):
+        '''
+        smoothed and upsampled velocity field of the current parameters (scaled by xi during power iteration)
+        :return: velocity field N*2*H*W
+        '''
+        scale = self.xi if self.power_iteration and self.is_training else 1.
+        return self.smooth_velocity(scale*self.param, smooth=True)
+
+    def _get_deformation(self, inverse=False):
+        '''
+        deformation of the current parameters (scaled by xi during power iteration), computed when first asked for.
+        without gradient tracking, the smoothed velocity and each direction are cached
+        until the parameters or the settings change. with batch_directions, both directions are computed at once.
+        :param inverse: if true, return the inverse deformation
+        :return: dxy, disp
+        '''
+        track_grad = torch.is_grad_enabled() and self.param.requires_grad
+        if track_grad:
+            # every output gets its own graph, callers may backpropagate through them separately
+            self._deformation_cache = None
+            return self._integrate_direction(self.get_velocity(), inverse)
+        key = self._deformation_cache_key()
+        cache = self._deformation_cache
+        # compare values, in-place edits through .data do not bump the version counter
+        if cache is None or cache[0] != key or not torch.equal(cache[1], self.param):
+            cache = (key, self.param.detach().clone(), {})
+            self._deformation_cache = cache
+        fields = cache[2]
+        if inverse not in fields:
+            if 'velocity' not in fields:
+                fields['velocity'] = self.get_velocity()
+            velocity = fields['velocity']
+            if self.batch_directions and False not in fields and True not in fields:
+                dxy, disp = self._integrate_direction(torch.cat([velocity, -velocity], dim=0))
+                n = velocity.size(0)
+                fields[False] = (dxy[:n], disp[:n])
+                fields[True] = (dxy[n:], disp[n:])
+            else:
+                fields[inverse] = self._integrate_direction(velocity, inverse)
+        return fields[inverse]
+
+    def _integrate_direction(self, velocity, inverse=False):
+        if inverse:
+            # smoothing and upsampling are linear, so the inverse integrates the negated velocity
+            velocity = -velocity
+        dxy = self.integrate_velocity(
+            velocity, init_deformation_dxy=self.base_grid_wh)
+        disp = (dxy-self.base_grid_wh).permute(0, 2, 3, 1)  # N*H*W*2
+        return dxy, disp
+
+    def _deformation_cache_key(self):
+        '''
+        settings that change the deformation of given parameters
+        '''
+        scale = self.xi if self.power_iteration and self.is_training else 1.
+        return (scale, self.sigma, self.smooth_iter, self.gaussian_ks, self.num_steps, self.integration_type,
+                self.integration_dtype, self.compile_integration, id(self.base_grid_wh))
+
+    def get_smooth_sigma(self, height, width):
+        '''
+        sigma of the extra gaussian pass applied to a height*width velocity when smooth=True
+        '''
+        # the full resolution sigma, scaled down to the velocity resolution
+        upsample_factor = min(self.base_grid_wh.size(2) / height,
+                              self.base_grid_wh.size(3) / width)
+        return self.sigma / upsample_factor
+
+    def smooth_velocity(self, duv, smooth=False):
+        '''
+        smooth the low resolution velocity field and upsample it to the image size
+        :param duv: velocity field N*2*h*w
+        :param smooth: apply additional smoothing to the deformation (on the low resolution velocity)
+        :return: velocity field N*2*H*W
+        '''
         duv = self.gaussian_smooth(
             duv, iter=self.smooth_iter, kernel_size=self.gaussian_ks, sigma=self.sigma)
+        if smooth:
+            # extra smoothing on the low resolution velocity instead of the full resolution offsets
+            duv = self.gaussian_smooth(
+                duv, iter=1, kernel_size=self.gaussian_ks, sigma=self.get_smooth_sigma(duv.size(2), duv.size(3)))
         duv = F.interpolate(duv, size=(self.base_grid_wh.size(
             2), self.base_grid_wh.size(3)), mode='bilinear', align_corners=False)
+        return duv
 
+    def integrate_velocity(self, duv, init_deformation_dxy):
+        '''
+        :param duv: smoothed velocity field N*2*H*W
+        :param init_deformation_dxy:
+        :return:
+        new composed_deformation_grid N*2*H*W
+        '''
+        base_grid = self.base_grid_wh
+        if self.integration_dtype is not None and self.integration_type == 'ss':
+            # cached base grid in the integration precision, avoids casting the float32 one on every call
+            base_grid = _base_grid(base_grid.size(2), base_grid.size(3), base_grid.device, self.integration_dtype)
         integrated_offsets = vectorFieldExponentiation2D(duv=duv, nb_steps=self.num_steps,
-                                                         type=self.integration_type)
+                                                         type=self.integration_type, base_grid=base_grid,
+                                                         compile=self.compile_integration, dtype=self.integration_dtype)
 
         if integrated_offsets.size(2) != self.base_grid_wh.size(2) or integrated_offsets.size(3) != self.base_grid_wh.size(3):
             integrated_offsets = F.interpolate(integrated_offsets, size=(self.base_grid_wh.size(
                 2), self.base_grid_wh.size(3)), mode='bilinear', align_corners=False)
 
         # update deformation with composition
-        composed_deformation_grid = applyComposition2D(
-            init_deformation_dxy, integrated_offsets + self.base_grid_wh)
-        # smooth
-        if smooth:
-            smoothed_offset = self.gaussian_smooth(composed_deformation_grid - self.base_grid_wh, sigma=self.sigma,
-                                                   kernel_size=self.gaussian_ks, iter=1)
-            composed_deformation_grid = smoothed_offset + self.base_grid_wh
-        composed_deformation_grid = torch.clamp(
-            composed_deformation_grid, -1, 1)
+        if init_deformation_dxy is self.base_grid_wh:
+            # bilinear sampling of the uniform base grid (align_corners, border padding) is exact
+            # for a linear field, so composing with it reduces to an elementwise clamp
+            composed_deformation_grid = torch.clamp(
+                integrated_offsets + self.base_grid_wh, -1, 1)
+        else:
+            composed_deformation_grid = applyComposition2D(
+                init_deformation_dxy.expand(integrated_offsets.size(0), -1, -1, -1),
+                integrated_offsets + self.base_grid_wh)
+            composed_deformation_grid.clamp_(-1, 1)
         return composed_deformation_grid
 
     def train(self):
@@ -427,7 +583,9 @@ if __name__ == "__main__":
     from advchain.common.utils import check_dir
     dir_path = './log'
     check_dir(dir_path, create=True)
-    images = torch.zeros((10, 1, 128, 128)).float().cuda()
+    use_gpu = torch.cuda.is_available()
+    device = torch.device('cuda') if use_gpu else torch.device('cpu')
+    images = torch.zeros((10, 1, 128, 128), device=device).float()
     images[:, :, ::8, :] = 0.5
     images[:, :, :, ::8] = 0.5
 
@@ -439,9 +597,9 @@ if __name__ == "__main__":
                                       'interpolator_mode': 'bilinear'
                                       },
 
-                         debug=True, use_gpu=True)
+                         debug=True, use_gpu=use_gpu)
     augmentor.init_parameters()
-    transformed = augmentor.forward(images.cuda())
+    transformed = augmentor.forward(images)
     recovered = augmentor.backward(transformed)
     error = recovered-images
     print('sum error', torch.sum(error))